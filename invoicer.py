@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 
-import yaml
+import io
 import textwrap
 import argparse
 import os, sys, datetime
-from typing import List
-from pydantic import BaseModel
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Spacer
-from reportlab.lib import colors
+import multiprocessing
+import functools
+from typing import List, Optional, Set, Tuple
+from pydantic import BaseModel, PrivateAttr
 
 # settings struct, it contains:
 # - output directory
@@ -21,11 +20,15 @@ class Settings(BaseModel):
     invoice_footer: List[str]
     # payment instructions
     payment_instructions: dict
+    # invoice numbers already used in the output directory and the next free one,
+    # computed once in read_settings so that invoices do not have to rescan the directory
+    _used_invoice_numbers: Set[int] = PrivateAttr(default_factory=set)
+    _next_number: int = PrivateAttr(default=1)
 
 SETTINGS_FILE = "~/.config/invoicer.yml"
 
-# global settings variable
-settings = None
+# wrapper used for the multiline item descriptions in the pdf, built once and reused for every row
+_DESC_WRAPPER = textwrap.TextWrapper(width=40)
 
 # struct for invoice item, it contains:
 # - description
@@ -55,49 +58,57 @@ class Invoice(BaseModel):
     invoice_number: int = 0
     invoice_currency: str
     # invoice date is optional, if not specified, it is the current date in italian format
-    invoice_date: str = datetime.datetime.now().strftime("%d/%m/%Y")
+    invoice_date: str = ""
     invoice_items: List[InvoiceItem]
     # optional field
     invoice_total_price: float = 0.0
 
-    def __init__(self, **data):
-        super().__init__(**data)
-        # if the invoice date is not specified, it is the current date in italian format
-        if not self.invoice_date:
-            self.invoice_date = datetime.datetime.now().strftime("%d/%m/%Y")
-
-        # if the invoice number is specified and the file starting with the invoice number already exists, exit
-        if self.invoice_number:
-            for file in os.listdir(settings.output_directory):
-                if file.startswith(str(self.invoice_number)):
-                    print(f"Error: file with invoice number {self.invoice_number} already exists")
-                    sys.exit(1)
-
-        # if the invoice number is not specified, it is the last invoice number in the output directory (if any) + 1
-        if not self.invoice_number:
-            self.invoice_number = self.get_next_invoice_number()
-
-
-    # function that returns the next invoice number
-    def get_next_invoice_number(self) -> int:
-
-        # get the invoice number. it is an incremental number based on the last invoice number in the output directory (if any)
-        # the invoice files are in this format: {invoice_number}_customer_name.pdf. example: 1_acme.pdf
-        # customer_name is the customer name in camel case format
-        invoice_number = 1
-        for file in os.listdir(settings.output_directory):
-            if file.endswith(".pdf") and file.split("_")[0].isdigit():
-                # get the invoice number from the file name
-                file_invoice_number = int(file.split("_")[0])
-                print(f"file_invoice_number: {file_invoice_number}")
-                if file_invoice_number >= invoice_number:
-                    invoice_number = file_invoice_number + 1
-        return invoice_number
+# function that assigns the invoice number and reserves it in the settings, so that the next invoice gets a new one.
+# this is kept out of the Invoice constructor, so that building an Invoice has no side effects
+def assign_invoice_number(invoice: Invoice, settings: Settings) -> None:
+    # if the invoice number is specified and a pdf with the same invoice number already exists, exit.
+    # the numbers are compared exactly, so invoice 1 does not clash with 10_acme.pdf
+    if invoice.invoice_number and invoice.invoice_number in settings._used_invoice_numbers:
+        print(f"Error: file with invoice number {invoice.invoice_number} already exists")
+        sys.exit(1)
+
+    # if the invoice number is not specified, it is the last invoice number in the output directory (if any) + 1
+    if not invoice.invoice_number:
+        invoice.invoice_number = settings._next_number
+
+    settings._used_invoice_numbers.add(invoice.invoice_number)
+    if invoice.invoice_number >= settings._next_number:
+        settings._next_number = invoice.invoice_number + 1
+
+# function that scans the output directory once and returns the invoice numbers already in use.
+# the invoice files are in this format: {invoice_number}_customer_name.pdf. example: 1_acme.pdf
+def _scan_invoices(directory: str) -> Set[int]:
+    invoice_numbers = set()
+    with os.scandir(directory) as it:
+        for entry in it:
+            name = entry.name
+            if not name.endswith(".pdf"):
+                continue
+            separator = name.find("_")
+            if separator <= 0:
+                continue
+            # get the invoice number from the file name
+            file_invoice_number = name[:separator]
+            if file_invoice_number.isdigit():
+                invoice_numbers.add(int(file_invoice_number))
+    return invoice_numbers
+
+# function that parses a yaml file.
+# yaml is imported here, so that it is not loaded when the script exits early (e.g. --help)
+def _load_yaml(file) -> dict:
+    import yaml
+    # use the libyaml based loader if available, it is much faster than the pure python one
+    return yaml.load(file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 # function that reads the settings file and returns a settings dictionary
 def read_settings() -> Settings:
     with open(os.path.expanduser(SETTINGS_FILE), 'r') as file:
-        settings = yaml.safe_load(file)
+        settings = _load_yaml(file)
 
     # convert the settings dictionary to a Settings object
     settings = Settings(**settings)
@@ -107,58 +118,133 @@ def read_settings() -> Settings:
         print(f"Error: output directory {settings.output_directory} does not exist")
         sys.exit(1)
 
+    # cache the invoice numbers already in use and the next free one
+    settings._used_invoice_numbers = _scan_invoices(settings.output_directory)
+    settings._next_number = max(settings._used_invoice_numbers, default=0) + 1
+
     return settings
 
 # function that reads the template and returns the invoice
-def read_template(template_file: str) -> Invoice:
+def read_template(template_file: str, settings: Settings) -> Invoice:
     # if the template file does not exist, exit
     if not os.path.exists(template_file):
         print(f"Error: template file {template_file} does not exist")
         sys.exit(1)
 
     with open(template_file, 'r') as file:
-        invoice = yaml.safe_load(file)
+        invoice = _load_yaml(file)
 
     # convert the invoice dictionary to an Invoice object
     invoice = Invoice(**invoice)
 
+    # if there are no payment instructions for the invoice currency, exit before an invoice number is assigned
+    if invoice.invoice_currency.lower() not in settings.payment_instructions:
+        print(f"Error: no payment instructions for currency {invoice.invoice_currency} in template file {template_file}")
+        sys.exit(1)
+
+    # if the invoice date is not specified, it is the current date in italian format
+    if not invoice.invoice_date:
+        invoice.invoice_date = datetime.datetime.now().strftime("%d/%m/%Y")
+
+    assign_invoice_number(invoice, settings)
+
     return invoice
 
-# function that returns the total price of the invoice
-def calculate_total_price(invoice: Invoice) -> float:
-    total_price = 0.0
-    for item in invoice.invoice_items:
-        total_price += item.unit_price * item.quantity
-    return total_price
+# function that returns the total price of each item and the total price of the invoice
+def calculate_prices(invoice: Invoice) -> Tuple[List[float], float]:
+    item_prices = [item.unit_price * item.quantity for item in invoice.invoice_items]
+    return item_prices, sum(item_prices)
 
 # function that prints the invoice to a pdf file in the output directory.
 def print_invoice(invoice: Invoice) -> None:
-    print("Invoice")
-    print("-------")
-    print("Customer Name: " + invoice.customer_name)
-    print("Customer Address1: " + invoice.customer_address1)
-    print("Customer Address2: " + invoice.customer_address2)
-    print("Customer Business Number: " + invoice.customer_business_number)
-    print("Invoice Number: " + str(invoice.invoice_number))
-    print("Invoice Currency: " + invoice.invoice_currency)
-    print("Invoice Date: " + invoice.invoice_date)
-    print("Invoice Items:")
-    for item in invoice.invoice_items:
-        print("\tDescription: " + item.description)
-        print("\tQuantity: " + str(item.quantity))
-        print("\tUnit Price: " + str(item.unit_price))
-        print("\tTotal Price: " + str(item.unit_price * item.quantity))
-    print("Invoice Total Price: " + str(calculate_total_price(invoice)))
-    print("-------")
+    # the lines are collected and written with a single write call
+    lines = [
+        "Invoice",
+        "-------",
+        f"Customer Name: {invoice.customer_name}",
+        f"Customer Address1: {invoice.customer_address1}",
+        f"Customer Address2: {invoice.customer_address2}",
+        f"Customer Business Number: {invoice.customer_business_number}",
+        f"Invoice Number: {invoice.invoice_number}",
+        f"Invoice Currency: {invoice.invoice_currency}",
+        f"Invoice Date: {invoice.invoice_date}",
+        "Invoice Items:",
+    ]
+    item_prices, total_price = calculate_prices(invoice)
+    for item, item_total_price in zip(invoice.invoice_items, item_prices):
+        lines.append(f"\tDescription: {item.description}")
+        lines.append(f"\tQuantity: {item.quantity}")
+        lines.append(f"\tUnit Price: {item.unit_price}")
+        lines.append(f"\tTotal Price: {item_total_price}")
+    lines.append(f"Invoice Total Price: {total_price}")
+    lines.append("-------")
+    sys.stdout.write("\n".join(lines) + "\n")
+
+# function that returns the styles of the pdf tables.
+# the styles are the same for every invoice, so they are built once per process and reused.
+# reportlab is imported here, so that it is loaded only when a pdf is actually generated
+@functools.lru_cache(maxsize=None)
+def _table_styles() -> dict:
+    from reportlab.platypus import TableStyle
+    from reportlab.lib import colors
+
+    return {
+        "header": TableStyle([
+            # first row is bold
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ]),
+        "customer": TableStyle([
+            # first row is bold
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ]),
+        "details": TableStyle([
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 0), (-1, -1), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
+            ('TOPPADDING', (0, 0), (-1, -1), 5),
+            ('BACKGROUND', (0, 0), (-1, -1), colors.lightgrey),
+        ]),
+        "items": TableStyle([
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('ALIGN', (0, 0), (0, 0), 'LEFT'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
+            ('TOPPADDING', (0, 0), (-1, -1), 5),
+            ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
+            ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+            # last row font is bold
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ]),
+        "payment": TableStyle([
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('ALIGN', (0, 0), (0, 0), 'LEFT'),
+            ('VALIGN', (0, 0), (0, 0), 'MIDDLE'),
+            ('TOPPADDING', (0, 0), (-1, -1), 5),
+        ]),
+        "footer": TableStyle([
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('ALIGN', (0, 0), (0, 0), 'LEFT'),
+            ('VALIGN', (0, 0), (0, 0), 'MIDDLE'),
+            ('TOPPADDING', (0, 0), (-1, -1), 5),
+        ]),
+    }
 
 # function that outputs the invoice to a pdf file in the output directory.
 # the pdf file name is: {invoice_number}_customer_name.pdf. example: 0001_acme.pdf
 # customer_name is the customer name in camel case format
 def output_pdf(invoice: Invoice, settings: Settings) -> None:
-    # check in the settings file if the output directory exists
-    if not os.path.exists(settings.output_directory):
-        print(f"Error: output directory {settings.output_directory} does not exist")
-        sys.exit(1)
+    # reportlab has a large import graph, import it only when a pdf is actually generated
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Table, Spacer
 
     # get the invoice number. it is an incremental number based on the last invoice number in the output directory (if any)
     # the invoice files are in this format: {invoice_number}_customer_name.pdf. example: 1_acme.pdf
@@ -171,17 +257,13 @@ def output_pdf(invoice: Invoice, settings: Settings) -> None:
     # Prepare the PDF file name and path
     pdf_file_name = f"{settings.output_directory}/{invoice_number}_{customer_name}.pdf"
 
-    # Set up the document
-    doc = SimpleDocTemplate(pdf_file_name, pagesize=letter)
+    styles = _table_styles()
     elements = []
 
     # header table
     header_data = [[header_text] for header_text in settings.invoice_header]
     header_table = Table(header_data)
-    header_table.setStyle(TableStyle([
-        # first row is bold
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ]))
+    header_table.setStyle(styles["header"])
 
     # custgomer table
     customer_data = [
@@ -194,10 +276,7 @@ def output_pdf(invoice: Invoice, settings: Settings) -> None:
             [],
     ]
     customer_table = Table(customer_data)
-    customer_table.setStyle(TableStyle([
-        # first row is bold
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-    ]))
+    customer_table.setStyle(styles["customer"])
 
     combined_table = Table([[header_table, customer_table]], colWidths=[265, 300])
 
@@ -213,14 +292,7 @@ def output_pdf(invoice: Invoice, settings: Settings) -> None:
 
     ]
     details_table = Table(invoice_data, colWidths=[240, 300])
-    details_table.setStyle(TableStyle([
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
-        ('TOPPADDING', (0, 0), (-1, -1), 5),
-        ('BACKGROUND', (0, 0), (-1, -1), colors.lightgrey),
-    ]))
+    details_table.setStyle(styles["details"])
     elements.append(details_table)
 
     # add whitespace
@@ -228,33 +300,17 @@ def output_pdf(invoice: Invoice, settings: Settings) -> None:
 
     # Write the invoice items to the PDF
     items_data = [['Description', 'Quantity', 'Unit Price', 'Total Price']]
-    for item in invoice.invoice_items:
+    item_prices, invoice_total_price = calculate_prices(invoice)
+    for item, total_price in zip(invoice.invoice_items, item_prices):
         # multiline description, do not use Paragraph(item.description, styles["Normal"])
-        description = textwrap.fill(item.description, 40)
-        quantity = item.quantity
-        unit_price = item.unit_price
-        total_price = item.unit_price * item.quantity
-        items_data.append([description, quantity, unit_price, total_price])
+        description = _DESC_WRAPPER.fill(item.description)
+        items_data.append([description, item.quantity, item.unit_price, total_price])
 
     # add the total price to the invoice and the currency
-    items_data.append([f"Tot ({invoice.invoice_currency}):", '', '', f"{calculate_total_price(invoice)} {invoice.invoice_currency}"])
+    items_data.append([f"Tot ({invoice.invoice_currency}):", '', '', f"{invoice_total_price} {invoice.invoice_currency}"])
 
     items_table = Table(items_data, colWidths=[250, 90, 100, 100], repeatRows=1)
-    items_table.setStyle(TableStyle([
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('ALIGN', (0, 0), (0, 0), 'LEFT'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
-        ('TOPPADDING', (0, 0), (-1, -1), 5),
-        ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
-        ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
-        # last row font is bold
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-    ]))
+    items_table.setStyle(styles["items"])
     elements.append(items_table)
 
     # spacer
@@ -272,14 +328,7 @@ def output_pdf(invoice: Invoice, settings: Settings) -> None:
     payment_data.append([payment_instructions])
 
     payment_table = Table(payment_data, colWidths=[550])
-    payment_table.setStyle(TableStyle([
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('ALIGN', (0, 0), (0, 0), 'LEFT'),
-        ('VALIGN', (0, 0), (0, 0), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, -1), 5),
-    ]))
+    payment_table.setStyle(styles["payment"])
     elements.append(payment_table)
 
     # spacer
@@ -288,27 +337,33 @@ def output_pdf(invoice: Invoice, settings: Settings) -> None:
     # Add footer to each page
     footer_data = [[footer_text] for footer_text in settings.invoice_footer]
     footer_table = Table(footer_data, colWidths=[550], rowHeights=20)
-    footer_table.setStyle(TableStyle([
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('ALIGN', (0, 0), (0, 0), 'LEFT'),
-        ('VALIGN', (0, 0), (0, 0), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, -1), 5),
-    ]))
+    footer_table.setStyle(styles["footer"])
     elements.append(footer_table)
 
-    # Build the PDF document
+    # Build the PDF document in memory and write it to the output file in one go.
+    # the file is created only once the build succeeded, so that a failed build leaves no pdf behind
+    # (it would use up the invoice number on the next run)
+    stream = io.BytesIO()
+    doc = SimpleDocTemplate(stream, pagesize=letter)
     doc.build(elements)
 
+    try:
+        with open(pdf_file_name, "wb") as file:
+            file.write(stream.getbuffer())
+    except BaseException:
+        # remove the partially written pdf
+        if os.path.exists(pdf_file_name):
+            os.remove(pdf_file_name)
+        raise
+
 def main( args: argparse.Namespace) -> None:
-    global settings
-    # if there is no template file, exit
-    if not os.path.exists(args.template_file):
-        print(f"Error: template file {args.template_file} does not exist")
-        sys.exit(1)
+    # if there is a missing template file, exit
+    for template_file in args.template_files:
+        if not os.path.exists(template_file):
+            print(f"Error: template file {template_file} does not exist")
+            sys.exit(1)
 
-    # Read the settings from the file
+    # Read the settings from the file, once for all the templates
     settings = read_settings()
 
     # if settings is none, exit
@@ -316,16 +371,43 @@ def main( args: argparse.Namespace) -> None:
         print("Error: settings is None")
         sys.exit(1)
 
-    # Read the template from the file
-    invoice = read_template(args.template_file)
+    # Read and validate all the templates first, so that an invalid template stops the batch before any pdf is written.
+    # invoice numbers are assigned from the cached settings, so they keep incrementing across the batch
+    invoices = [read_template(template_file, settings) for template_file in args.template_files]
+
+    # Print the invoices, only in verbose mode
+    if args.verbose:
+        for invoice in invoices:
+            print_invoice(invoice)
+
+    # a single invoice is rendered in process, a batch is rendered in parallel.
+    # invoice numbers are already assigned above, so the workers do not race on them
+    if len(invoices) == 1:
+        errors = [_output_pdf_worker(invoices[0], settings)]
+    else:
+        with multiprocessing.Pool(min(len(invoices), os.cpu_count() or 1)) as pool:
+            errors = pool.starmap(_output_pdf_worker, [(invoice, settings) for invoice in invoices])
+
+    # if any invoice failed, print the errors and exit
+    errors = [error for error in errors if error]
+    if errors:
+        for error in errors:
+            print(f"Error: {error}")
+        sys.exit(1)
 
-    # Print the invoice
-    print_invoice(invoice)
-    output_pdf(invoice, settings)
+# function that renders an invoice and returns the error message if it fails, None otherwise.
+# the error is returned instead of raised, so that a failure in a pool worker is reported as a clean error line
+def _output_pdf_worker(invoice: Invoice, settings: Settings) -> Optional[str]:
+    try:
+        output_pdf(invoice, settings)
+    except Exception as e:
+        return f"could not write invoice {invoice.invoice_number} for {invoice.customer_name}: {e}"
+    return None
 
 def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("template_file", help="the template file to use")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the invoice details to the console")
+    parser.add_argument("template_files", nargs="+", help="the template files to use, one invoice is generated for each")
     return parser.parse_args()
 
 if __name__ == "__main__":